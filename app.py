@@ -1,8 +1,9 @@
 # app.py — Streamlit site for your ISFE2 Assistant (uses your doc as extra instructions)
 # Works on Streamlit Cloud (st.secrets) and locally (.env)
 
-import os, time
+import os, re, json, time, uuid, threading
 import streamlit as st
+import streamlit.components.v1 as components
 from dotenv import load_dotenv
 from openai import OpenAI
 
@@ -26,7 +27,15 @@ if ASSISTANT_ID.startswith("asst_proj_"):
              "Please use the plain 'asst_' ID from the same Project (or switch to a project-aware build).")
     st.stop()
 
-client = OpenAI(api_key=API_KEY)
+MAX_RETRIES = 5
+
+@st.cache_resource(show_spinner=False)
+def get_client(api_key: str) -> OpenAI:
+    # One client (and HTTP connection pool) per process, reused across reruns and sessions.
+    # The SDK retries 429 / 5xx / connection errors itself with jittered exponential backoff.
+    return OpenAI(api_key=api_key, max_retries=MAX_RETRIES)
+
+client = get_client(API_KEY)
 
 # ---------- Your ISFE2 behaviour (from the attached Word doc) ----------
 INSTRUCTIONS = """
@@ -79,89 +88,343 @@ Use either a brief open question or a simple multiple-choice.
 Always answer the user's **latest** message directly first, then optional extras (tips, related steps, links).
 """
 
+# Opt-in: write INSTRUCTIONS onto the assistant (replacing what is set in the dashboard)
+# so runs don't have to carry them. Needs a key with write access to assistants.
+SYNC_INSTRUCTIONS = str(get_secret("SYNC_ASSISTANT_INSTRUCTIONS") or "").lower() in ("1", "true", "yes")
+
+@st.cache_resource(ttl=600, show_spinner=False)
+def sync_assistant_instructions(assistant_id: str, instructions: str) -> str:
+    """
+    Store `instructions` on the assistant, instead of sending them with every run.
+    Only updates when the stored text differs. The text is part of the cache key,
+    so editing INSTRUCTIONS re-syncs; the ttl re-checks (or retries a failure)
+    every 10 minutes. Returns "" on success, else the error.
+    """
+    try:
+        assistant = client.beta.assistants.retrieve(assistant_id)
+        if assistant.instructions != instructions:
+            client.beta.assistants.update(assistant_id, instructions=instructions)
+    except Exception as e:
+        return str(e)
+    return ""
+
+SYNC_ERROR = sync_assistant_instructions(ASSISTANT_ID, INSTRUCTIONS) if SYNC_INSTRUCTIONS else ""
+INSTRUCTIONS_ON_ASSISTANT = SYNC_INSTRUCTIONS and not SYNC_ERROR
+
 # ---------- Page UI ----------
 st.set_page_config(page_title="ISFE2 Assistant", page_icon="💬")
 st.title("ISFE2 Assistant")
 st.caption("Ask about ISFE2 / Oracle Fusion (NHS ICB)")
-
-with st.sidebar:
-    def mask(s): 
-        return f"{s[:7]}…{s[-4:]}" if isinstance(s, str) and len(s) >= 12 else str(bool(s))
-    st.markdown("### Status")
-    st.write(f"API key: {mask(API_KEY)}  |  Assistant ID: {ASSISTANT_ID[:5]}…")
-    if st.button("Reset chat"):
-        st.session_state.clear()
-        st.rerun()
+if SYNC_ERROR:
+    st.warning(f"Could not update assistant instructions ({SYNC_ERROR}); "
+               "sending them with each message instead.")
 
 # ---------- Helpers ----------
-def ensure_thread():
-    if "thread_id" not in st.session_state:
-        try:
-            st.session_state.thread_id = client.beta.threads.create().id
-            st.session_state.history = []
-        except Exception as e:
-            st.error(f"Could not create thread: {e}")
-            st.stop()
-
-def latest_assistant_reply(thread_id: str) -> str:
+HISTORY_WINDOW = 50  # most recent messages rendered inline; older ones go in an expander
+SESSIONS_DIR = os.path.join(".isfe2", "sessions")  # thread_id + history per browser, survives refresh
+SESSION_COOKIE = "isfe2_sid"
+SESSION_TTL = 30 * 24 * 3600  # seconds; saved chats (and the cookie) expire after 30 days idle
+COMPACT_AFTER = 20            # messages on one thread before it is condensed into a summary
+SUMMARY_MODEL = get_secret("SUMMARY_MODEL") or "gpt-4o-mini"
+SUMMARY_PROMPT = (
+    "Summarise this conversation between an NHS ICB staff member and the ISFE2 Assistant "
+    "so it can continue without the full transcript. Keep the user's role, directorate, "
+    "cost centres, process stage, open questions and any answers or steps already given. "
+    "Use concise UK English bullet points."
+)
+
+def session_path() -> str:
     """
-    Return the newest assistant message only.
-    We request messages newest→oldest to avoid reusing an old answer.
+    Path of this browser's saved session. The id lives in a cookie rather than the
+    URL, so sharing a link to the site doesn't share the conversation.
     """
-    msgs = client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=10)
-    for m in msgs.data:  # newest first
-        if m.role == "assistant":
-            parts = []
-            for c in m.content:
-                if c.type == "text":
-                    parts.append(c.text.value)
-            if parts:
-                return "\n\n".join(parts)
-    return "No reply received — please try again."
-
-def ask_assistant(thread_id: str, question: str) -> str:
+    if "sid" not in st.session_state:
+        sid = st.context.cookies.get(SESSION_COOKIE, "")
+        if not re.fullmatch(r"[0-9a-f]{32}", sid):
+            sid = uuid.uuid4().hex
+        st.session_state.sid = sid
+    return os.path.join(SESSIONS_DIR, f"{st.session_state.sid}.json")
+
+def remember_session_id():
+    # Set (or extend) the cookie from the browser; Streamlit can only read cookies.
+    # Renders an empty, zero-height frame.
+    components.html(
+        f"<script>window.parent.document.cookie = '{SESSION_COOKIE}={st.session_state.sid}; "
+        f"path=/; max-age={SESSION_TTL}; SameSite=Strict';</script>",
+        height=0,
+    )
+
+@st.cache_resource(show_spinner=False)
+def session_lock() -> threading.Lock:
+    # Serialises read-check-write of session files across all sessions in this process
+    return threading.Lock()
+
+def read_session(path: str):
+    """Return the saved session at `path`, or None if it is missing, expired or malformed."""
     try:
-        # Add the user message
-        client.beta.threads.messages.create(thread_id=thread_id, role="user", content=question)
+        if time.time() - os.path.getmtime(path) > SESSION_TTL:
+            os.remove(path)
+            return None
+        with open(path, encoding="utf-8") as f:
+            d = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return d if valid_session(d) else None
 
-        # Run the Assistant with your doc as extra instructions (overrides/augments style)
-        run = client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=ASSISTANT_ID,
-            additional_instructions=INSTRUCTIONS  # <- key bit: injects your behaviour each time
+def saved_key(d):
+    # What we last saw on disk: enough to tell whether another tab has written since
+    return (d["thread_id"], len(d["history"]["roles"])) if d else None
+
+def use_session(d):
+    st.session_state.thread_id = d["thread_id"]
+    st.session_state.history = d["history"]
+    st.session_state.thread_start = d.get("thread_start", 0)
+    st.session_state.summary = d.get("summary", "")
+    st.session_state.saved = saved_key(d)
+
+def save_session():
+    """
+    Write this tab's chat to disk. Tabs in the same browser share the file, so if
+    another tab has saved since we last loaded or saved, build on its copy:
+    append our new turns if it is still the same thread, otherwise switch to it.
+    """
+    path = session_path()
+    with session_lock():
+        stored = read_session(path)
+        base = st.session_state.get("saved")
+        if stored and saved_key(stored) != base:
+            if base and stored["thread_id"] == base[0] == st.session_state.thread_id:
+                # Same thread, more turns from the other tab: keep both
+                new = st.session_state.history
+                stored["history"]["roles"] += new["roles"][base[1]:]
+                stored["history"]["msgs"] += new["msgs"][base[1]:]
+            else:
+                use_session(stored)
+                st.warning("This chat was changed in another tab; switched to the latest version.")
+                return
+        else:
+            stored = {
+                "thread_id": st.session_state.thread_id,
+                "history": st.session_state.history,
+                "thread_start": st.session_state.thread_start,
+                "summary": st.session_state.summary,
+            }
+        os.makedirs(SESSIONS_DIR, exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(stored, f)
+        os.replace(tmp, path)
+        use_session(stored)
+    remember_session_id()
+
+def valid_session(d) -> bool:
+    if not isinstance(d, dict) or not isinstance(d.get("thread_id"), str):
+        return False
+    hist = d.get("history")
+    if not isinstance(hist, dict) or set(hist) != {"roles", "msgs"}:
+        return False
+    roles, msgs = hist["roles"], hist["msgs"]
+    if not isinstance(roles, list) or not isinstance(msgs, list) or len(roles) != len(msgs):
+        return False
+    return (all(isinstance(x, str) for x in roles + msgs)
+            and isinstance(d.get("thread_start", 0), int)
+            and isinstance(d.get("summary", ""), str))
+
+def load_session() -> bool:
+    d = read_session(session_path())
+    if d is None:
+        return False
+    use_session(d)
+    return True
+
+def drop_session():
+    try:
+        os.remove(session_path())
+    except OSError:
+        pass
+
+@st.cache_resource(ttl=24 * 3600, show_spinner=False)
+def prune_sessions() -> bool:
+    """Delete saved sessions idle for longer than SESSION_TTL (at most once a day per process)."""
+    cutoff = time.time() - SESSION_TTL
+    try:
+        with os.scandir(SESSIONS_DIR) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return True
+
+def create_thread():
+    try:
+        st.session_state.thread_id = client.beta.threads.create().id
+    except Exception as e:
+        st.error(f"Could not create thread: {e}")
+        st.stop()
+
+def new_chat():
+    st.session_state.thread_id = None  # created on the first message (or by Reset)
+    st.session_state.history = {"roles": [], "msgs": []}
+    st.session_state.thread_start = 0  # index in history where the current thread begins
+    st.session_state.summary = ""      # summary the current thread was seeded with, if any
+    st.session_state.pop("compact_retry_at", None)
+    st.session_state.saved = None      # nothing on disk for this chat yet
+
+def ensure_chat():
+    if "thread_id" not in st.session_state and not load_session():
+        new_chat()
+
+def compact_thread() -> bool:
+    """
+    Once the current thread holds more than COMPACT_AFTER messages, summarise it
+    and carry on in a fresh thread seeded with that summary, so each run reads a
+    bounded context. The on-screen history is kept as it is.
+    Returns True if the session switched to a new thread.
+    """
+    hist = st.session_state.history
+    start = st.session_state.thread_start
+    n = len(hist["roles"])
+    if n - start <= COMPACT_AFTER or n < st.session_state.get("compact_retry_at", 0):
+        return False
+    # Error/status notes we showed locally were never part of the thread; leave them out
+    transcript = "\n\n".join(
+        f"{r}: {m}" for r, m in zip(hist["roles"][start:], hist["msgs"][start:])
+        if not (r == "assistant" and m.startswith(LOCAL_REPLIES))
+    )
+    if st.session_state.summary:
+        transcript = f"Summary of earlier conversation:\n{st.session_state.summary}\n\n{transcript}"
+    try:
+        # Not worth the client's usual retries: on failure we just try again later
+        resp = client.with_options(max_retries=1).chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript},
+            ],
         )
+        summary = resp.choices[0].message.content
+        thread_id = client.beta.threads.create(
+            messages=[{"role": "assistant", "content": summary}]
+        ).id
+    except Exception as e:
+        # Keep using the current thread; back off rather than retrying every turn
+        st.session_state.compact_retry_at = n + COMPACT_AFTER
+        st.warning(f"Could not condense the conversation ({e}); "
+                   f"will try again after {COMPACT_AFTER} more messages.")
+        return False
+    st.session_state.thread_id = thread_id
+    st.session_state.thread_start = n
+    st.session_state.summary = summary
+    return True
+
+def add_to_history(role: str, msg: str):
+    hist = st.session_state.history
+    hist["roles"].append(role)
+    hist["msgs"].append(msg)
 
-        # Poll until done (simple + Streamlit-friendly)
-        while True:
-            r = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-            if r.status == "completed":
-                break
-            if r.status in ("failed", "cancelled", "expired"):
-                return f"Sorry—assistant run ended with status: **{r.status}**."
-            time.sleep(0.35)
+def show_messages(roles, msgs):
+    for role, msg in zip(roles, msgs):
+        with st.chat_message(role):
+            st.markdown(msg)
 
-        return latest_assistant_reply(thread_id)
+# Replies ask_assistant produces itself (never part of the thread); see compact_thread
+RUN_ENDED_REPLY = "Sorry—assistant run ended with status: **{status}**."
+NO_REPLY = "No reply received — please try again."
+ERROR_REPLY = "Error talking to assistant: `{error}`"
+LOCAL_REPLIES = tuple(t.partition("{")[0] for t in (RUN_ENDED_REPLY, NO_REPLY, ERROR_REPLY))
+RUN_DONE = ("completed", "failed", "cancelled", "expired", "incomplete")
+CANCEL_WAIT = 5.0  # seconds to wait for a cancelled run to stop before giving up
+
+def cancel_unfinished_run(thread_id: str, run):
+    """
+    Cancel `run` if it is still going, and wait (briefly) until it has actually
+    stopped: cancel returns while the run is still "cancelling", and the thread
+    won't accept another run until it is done.
+    """
+    if run is None or run.status in RUN_DONE:
+        return
+    try:
+        run = client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+        deadline = time.monotonic() + CANCEL_WAIT
+        while run.status not in RUN_DONE and time.monotonic() < deadline:
+            time.sleep(0.2)
+            run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    except Exception:
+        pass  # best effort: the run may have just finished
+
+def ask_assistant(thread_id: str, question: str, placeholder) -> str:
+    """
+    Run the assistant on the thread and stream its reply into `placeholder`
+    as it arrives. Returns the full reply text.
+    """
+    try:
+        # Add the user message and run the Assistant in one request, with your doc as
+        # extra instructions unless it is already stored on the assistant
+        with client.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=ASSISTANT_ID,
+            additional_messages=[{"role": "user", "content": question}],
+            additional_instructions=None if INSTRUCTIONS_ON_ASSISTANT else INSTRUCTIONS,
+        ) as stream:
+            try:
+                parts = []
+                for delta in stream.text_deltas:
+                    parts.append(delta)
+                    placeholder.markdown("".join(parts))
+                run = stream.get_final_run()
+            finally:
+                # A rerun (user clicks or sends while we stream) interrupts us here; closing
+                # the stream doesn't stop the run, which would then block the thread.
+                cancel_unfinished_run(thread_id, stream.current_run)
+
+        if run.status != "completed":
+            return RUN_ENDED_REPLY.format(status=run.status)
+        return "".join(parts) or NO_REPLY
     except Exception as e:
-        return f"Error talking to assistant: `{e}`"
+        return ERROR_REPLY.format(error=e)
 
 # ---------- Chat UI ----------
-ensure_thread()
+with st.sidebar:
+    def mask(s): 
+        return f"{s[:7]}…{s[-4:]}" if isinstance(s, str) and len(s) >= 12 else str(bool(s))
+    st.markdown("### Status")
+    st.write(f"API key: {mask(API_KEY)}  |  Assistant ID: {ASSISTANT_ID[:5]}…")
+    if st.button("Reset chat"):
+        drop_session()
+        new_chat()  # only replaces the chat; other session keys are kept
+        create_thread()
+        st.rerun()
+
+prune_sessions()
+ensure_chat()
 
-# Show history
-for role, msg in st.session_state.get("history", []):
-    with st.chat_message(role):
-        st.markdown(msg)
+# Show history (only the tail is rendered inline, to keep reruns cheap)
+hist = st.session_state.history
+n = len(hist["roles"])
+if n > HISTORY_WINDOW:
+    with st.expander(f"Earlier messages ({n - HISTORY_WINDOW})"):
+        show_messages(hist["roles"][:-HISTORY_WINDOW], hist["msgs"][:-HISTORY_WINDOW])
+show_messages(hist["roles"][-HISTORY_WINDOW:], hist["msgs"][-HISTORY_WINDOW:])
 
 prompt = st.chat_input("Type your question…")
 if prompt:
-    st.session_state.history.append(("user", prompt))
+    if not st.session_state.thread_id:
+        create_thread()
+    add_to_history("user", prompt)
     with st.chat_message("user"):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
         ph = st.empty()
         ph.markdown("_Thinking…_")
-        answer = ask_assistant(st.session_state.thread_id, prompt)
+        answer = ask_assistant(st.session_state.thread_id, prompt, ph)
         ph.markdown(answer)
 
-    st.session_state.history.append(("assistant", answer))
+    add_to_history("assistant", answer)
+    save_session()
+    if compact_thread():
+        save_session()